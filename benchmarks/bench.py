@@ -0,0 +1,505 @@
+# Benchmarks the fetch-parse-render loop in code.py against replayed Google traffic.
+#
+# The functions under test are lifted straight out of code.py, so any change to get_iso_time(),
+# get_calendar_events(), format_datetime() or display_calendar_events() is measured as written.
+# The PyPortal, ESP32 and RTC objects they reach for are replaced by small host-side stand-ins,
+# and their HTTP requests go to replay_server.py instead of Google.
+#
+# code.py's MAX_EVENTS is overridden with each calendar size, so both maxResults and the number
+# of event labels grow with it. The device always runs with the value in code.py, and changes to
+# that value are not measured here.
+#
+# Numbers come from desktop CPython, not the SAMD51, so compare runs against each other rather
+# than against the device. Byte counts are real wire traffic, give or take the few request headers
+# http.client sends differently from adafruit_requests; times and memory are only relative.
+#
+#   python benchmarks/bench.py --output bench_output.json
+#   python benchmarks/bench.py --baseline benchmarks/baseline.json --latency-ms 120
+
+import argparse
+import ast
+import contextlib
+import datetime
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from urllib.parse import urlsplit
+
+from replay_server import ERROR_KINDS, MAX_RESULTS, ReplayServer, serve
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CODE_PATH = os.path.join(os.path.dirname(BENCH_DIR), "code.py")
+THRESHOLDS_PATH = os.path.join(BENCH_DIR, "thresholds.json")
+DEFAULT_SIZES = "0,1,5,25,100,500,1000,2500"
+# The functions bench.py pulls out of code.py. Everything else there touches real hardware.
+CODE_FUNCTIONS = ("create_event_labels", "get_iso_time", "get_calendar_events",
+                  "display_calendar_events", "format_datetime")
+# Stages of one pass through code.py's main loop. "auth" only runs when the token expires
+# and "format" is format_datetime() on its own, so neither is counted in the cycle total.
+STAGES = ("header", "auth", "fetch", "format", "render")
+CYCLE_STAGES = ("header", "fetch", "render")
+# Options that shape the replayed traffic. Runs that differ in any of them can't be compared;
+# sizes and repeats may differ freely.
+SHAPING_OPTIONS = ("latency_ms", "bandwidth_kbps", "error_rate", "error_kind", "seed")
+SECRETS = {
+    "google_email": "CALENDAR_ID",
+    "google_client_id": "BENCH_CLIENT_ID",
+    "google_client_secret": "BENCH_CLIENT_SECRET",
+    "google_access_token": "BENCH_ACCESS_TOKEN",
+    "google_refresh_token": "BENCH_REFRESH_TOKEN",
+    "timezone": "Etc/UTC",
+    "timezone_offset": "-08:00",
+}
+
+########## Host stand-ins ######################################################################
+
+class Response:
+    def __init__(self, status, body):
+        self.status_code = status
+        self.content = body
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        pass
+
+# Plays the part of adafruit_requests, sending every googleapis.com request to the replay server.
+class Requests:
+    def __init__(self, base_url):
+        self.netloc = urlsplit(base_url).netloc
+
+    def request(self, method, url, data=None, headers=None):
+        parts = urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        # A new connection per request, as the ESP32 socket pool does.
+        connection = http.client.HTTPConnection(self.netloc, timeout=60)
+        try:
+            body = data.encode() if isinstance(data, str) else data
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return Response(response.status, response.read())
+        finally:
+            connection.close()
+
+    def get(self, url, headers=None):
+        return self.request("GET", url, headers=headers)
+
+    def post(self, url, data=None, headers=None):
+        return self.request("POST", url, data=data, headers=headers)
+
+# Refreshes the token with the same request adafruit_oauth2.OAuth2.refresh_access_token sends.
+class GoogleAuth:
+    TOKEN_URL = "https://oauth2.googleapis.com/token"
+
+    def __init__(self, requests):
+        self.requests = requests
+        self.access_token = SECRETS["google_access_token"]
+        self.access_token_expiration = None
+
+    def refresh_access_token(self):
+        data = "client_id={}&client_secret={}&grant_type=refresh_token&refresh_token={}".format(
+            SECRETS["google_client_id"], SECRETS["google_client_secret"], SECRETS["google_refresh_token"]
+        )
+        headers = {"Content-Type": "application/x-www-form-urlencoded", "Content-Length": str(len(data))}
+        response = self.requests.post(self.TOKEN_URL, data=data, headers=headers)
+        if response.status_code != 200:
+            return False
+        token = response.json()
+        response.close()
+        self.access_token = token["access_token"]
+        self.access_token_expiration = token["expires_in"]
+        return True
+
+class Network:
+    def __init__(self, requests):
+        self.requests = requests
+
+    def connect(self):
+        pass
+
+class PyPortal:
+    def __init__(self, requests):
+        self.network = Network(requests)
+        self.labels = []
+
+    def add_text(self, text="", **kwargs):
+        self.labels.append(text)
+        return len(self.labels) - 1
+
+    def set_text(self, val, index=0):
+        self.labels[index] = val
+
+    def get_local_time(self, location=None):
+        pass
+
+class ESP:
+    def __init__(self):
+        self.resets = 0
+
+    def reset(self):
+        self.resets += 1
+
+    def disconnect(self):
+        pass
+
+class RTC:
+    @property
+    def datetime(self):
+        return time.localtime()
+
+# code.py backs off with time.sleep(5) between retries. The back-off is tallied instead of slept.
+class Clock:
+    def __init__(self):
+        self.slept = 0.0
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        self.slept += seconds
+
+# Swallows what code.py prints, counting it, since on the device every print goes out over serial.
+class Console:
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, text):
+        self.bytes += len(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+########## Functions ###########################################################################
+
+# Compiles the CODE_FUNCTIONS and the literal constants from code.py, skipping everything else.
+def load_code():
+    with open(CODE_PATH) as f:
+        tree = ast.parse(f.read(), CODE_PATH)
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in CODE_FUNCTIONS:
+            body.append(node)
+        elif isinstance(node, ast.Assign) and all(isinstance(t, ast.Name) for t in node.targets):
+            try:
+                ast.literal_eval(node.value)
+            except ValueError:
+                continue
+            body.append(node)
+    missing = set(CODE_FUNCTIONS) - {node.name for node in body if isinstance(node, ast.FunctionDef)}
+    if missing:
+        raise RuntimeError("code.py no longer defines: " + ", ".join(sorted(missing)))
+    return compile(ast.Module(body=body, type_ignores=[]), CODE_PATH, "exec")
+
+# Gives code.py's functions a fresh set of globals, with stand-ins for the hardware, sized for `size` events.
+def make_namespace(code, base_url, size):
+    requests = Requests(base_url)
+    namespace = {"__name__": "code"}
+    exec(code, namespace)
+    namespace.update(
+        secrets=SECRETS,
+        CALENDAR_ID=SECRETS["google_email"],
+        ZULU_TIME_OFFSET=SECRETS["timezone_offset"],
+        MAX_EVENTS=size,
+        datetime=datetime,
+        time=Clock(),
+        esp=ESP(),
+        r=RTC(),
+        pyportal=PyPortal(requests),
+        google_auth=GoogleAuth(requests),
+        event_labels=[],
+    )
+    namespace["label_date_header"] = namespace["pyportal"].add_text(text="Getting current time...")
+    namespace["create_event_labels"]()
+    return namespace
+
+# Runs each stage of one loop iteration once. `measure` wraps every stage, gets its name, and
+# returns False if it failed. Returns the names of the stages that failed.
+def run_cycle(ns, measure):
+    state = {}
+
+    def header():
+        state["now"] = ns["get_iso_time"]()
+        ns["pyportal"].set_text(ns["format_datetime"](state["now"], pretty_date=True), ns["label_date_header"])
+
+    def auth():
+        if not ns["google_auth"].refresh_access_token():
+            raise RuntimeError("Unable to refresh access token - has the token been revoked?")
+
+    def fetch():
+        state["events"] = ns["get_calendar_events"](state["now"])
+
+    def format_events():
+        for event in state["events"]:
+            ns["format_datetime"](event["start"]["dateTime"])
+
+    def render():
+        if state["events"]:
+            ns["display_calendar_events"](state["events"])
+
+    failed = []
+    for name, stage in zip(STAGES, (header, auth, fetch, format_events, render)):
+        if not measure(name, stage):
+            failed.append(name)
+            # code.py only refreshes its token about once an hour, so a failed refresh
+            # shouldn't cost the cycle. Any other failure leaves later stages nothing to work on.
+            if name != "auth":
+                break
+    return failed
+
+# Times `repeats` cycles with tracemalloc off. Returns per-stage timings, traffic and retry counts.
+def time_cycles(code, server, size, repeats):
+    times = {name: [] for name in STAGES}
+    cycles = []
+    traffic = {name: {"bytes_sent": 0, "bytes_received": 0, "requests": 0} for name in STAGES}
+    totals = {"failures": 0, "auth_failures": 0, "retries": 0, "injected_errors": 0, "backoff_s": 0.0,
+              "console_bytes": 0}
+
+    for repeat in range(repeats + 1):
+        # The first pass only warms things up and is thrown away.
+        warmup = repeat == 0
+        ns = make_namespace(code, server.base_url, size)
+        console = Console()
+        elapsed = {}
+
+        def measure(name, stage):
+            before = server.counters()
+            start = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(console):
+                    stage()
+                return True
+            except (RuntimeError, OSError):
+                return False
+            finally:
+                elapsed[name] = time.perf_counter() - start
+                after = server.counters()
+                if not warmup:
+                    for key in traffic[name]:
+                        traffic[name][key] += after[key] - before[key]
+                    totals["injected_errors"] += after["errors"] - before["errors"]
+
+        failed = run_cycle(ns, measure)
+        if warmup:
+            continue
+        totals["auth_failures"] += "auth" in failed
+        totals["failures"] += any(name != "auth" for name in failed)
+        totals["retries"] += ns["esp"].resets
+        totals["backoff_s"] += ns["time"].slept
+        totals["console_bytes"] += console.bytes
+        for name in STAGES:
+            if name in elapsed and name not in failed:
+                times[name].append(elapsed[name])
+        if not set(CYCLE_STAGES) & set(failed) and all(name in elapsed for name in CYCLE_STAGES):
+            cycles.append(sum(elapsed[name] for name in CYCLE_STAGES))
+
+    # Traffic is averaged over every cycle, since retries and failed cycles cost real bytes too.
+    for name in STAGES:
+        for key in traffic[name]:
+            traffic[name][key] = round(traffic[name][key] / repeats, 1)
+    totals["console_bytes"] = round(totals["console_bytes"] / repeats, 1)
+    return times, cycles, traffic, totals
+
+# Runs one cycle under tracemalloc. Reports each stage's peak memory and the blocks still alive after it.
+# Blocks a stage allocated and freed again only show up in its peak.
+# The server gets a process of its own, clean and instant, so only code.py's side is traced.
+def trace_cycle(code, size):
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=serve, args=(sender,), kwargs={"calendar_size": size}, daemon=True)
+    server.start()
+    memory = {}
+    try:
+        base_url = receiver.recv()
+        console = Console()
+        ignore_tracemalloc = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+        def measure(name, stage):
+            before = tracemalloc.take_snapshot().filter_traces(ignore_tracemalloc)
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            try:
+                with contextlib.redirect_stdout(console):
+                    stage()
+            except (RuntimeError, OSError):
+                return False
+            finally:
+                _, peak = tracemalloc.get_traced_memory()
+                after = tracemalloc.take_snapshot().filter_traces(ignore_tracemalloc)
+                grown = [stat for stat in after.compare_to(before, "lineno") if stat.count_diff > 0]
+                memory[name] = {
+                    "peak_bytes": peak - baseline,
+                    "retained_blocks": sum(stat.count_diff for stat in grown),
+                    "retained_bytes": sum(stat.size_diff for stat in grown),
+                }
+            return True
+
+        tracemalloc.start()
+        try:
+            # The first traced cycle is thrown away, as in time_cycles(), so one-time caches filled
+            # by whichever size runs first (tracemalloc's own included) aren't charged to it.
+            run_cycle(make_namespace(code, base_url, size), measure)
+            memory.clear()
+            run_cycle(make_namespace(code, base_url, size), measure)
+        finally:
+            tracemalloc.stop()
+    finally:
+        server.terminate()
+        server.join()
+    return memory
+
+def summarize(samples):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return {
+        "median": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        "min": ordered[0],
+        "samples": len(ordered),
+    }
+
+def benchmark(args):
+    code = load_code()
+    server = ReplayServer(
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_kbps * 1000 / 8,
+        error_rate=args.error_rate,
+        error_kind=args.error_kind,
+        seed=args.seed,
+    ).start()
+    results = {}
+    try:
+        for size in args.sizes:
+            print("=== Benchmarking", size, "events", file=sys.stderr)
+            server.calendar_size = size
+            server.calendar_body(size)
+            times, cycles, traffic, totals = time_cycles(code, server, size, args.repeats)
+            memory = trace_cycle(code, size)
+
+            stages = {}
+            for name in STAGES:
+                stages[name] = dict(time_s=summarize(times[name]), **traffic[name], **memory.get(name, {}))
+            results[str(size)] = dict(cycle_s=summarize(cycles), stages=stages, **totals)
+    finally:
+        server.stop()
+
+    return {
+        "meta": {
+            "python": platform.python_implementation() + " " + platform.python_version(),
+            "platform": platform.platform(),
+            "code": os.path.relpath(CODE_PATH, os.path.dirname(BENCH_DIR)),
+            "cycle_stages": list(CYCLE_STAGES),
+            "config": {
+                "sizes": args.sizes,
+                "repeats": args.repeats,
+                "latency_ms": args.latency_ms,
+                "bandwidth_kbps": args.bandwidth_kbps,
+                "error_rate": args.error_rate,
+                "error_kind": args.error_kind,
+                "seed": args.seed,
+            },
+        },
+        "results": results,
+    }
+
+# Yields (name, metric, baseline value, current value) for every metric the thresholds file can gate on.
+# Times are gated on their fastest run, which shrugs off scheduler noise far better than the median.
+def gated_metrics(baseline, current):
+    for size, result in current["results"].items():
+        base = baseline["results"].get(size)
+        if base is None:
+            continue
+        if base["cycle_s"] and result["cycle_s"]:
+            yield size + ".cycle_s", "time_s", base["cycle_s"]["min"], result["cycle_s"]["min"]
+        for stage, metrics in result["stages"].items():
+            base_metrics = base["stages"].get(stage, {})
+            for metric, value in metrics.items():
+                if metric not in base_metrics:
+                    continue
+                base_value = base_metrics[metric]
+                if metric == "time_s":
+                    if not (base_value and value):
+                        continue
+                    base_value, value = base_value["min"], value["min"]
+                yield "{}.{}.{}".format(size, stage, metric), metric, base_value, value
+
+# Compares `current` against `baseline`. Returns a list of human-readable regressions, empty if none.
+def check_regressions(baseline, current, thresholds):
+    regressions = []
+    for name, metric, base_value, value in gated_metrics(baseline, current):
+        rule = thresholds.get(metric)
+        if rule is None:
+            continue
+        limit = base_value * (1 + rule["max_increase"]) + rule.get("noise_floor", 0)
+        if value > limit:
+            regressions.append("{}: {:g} -> {:g} (limit {:g})".format(name, base_value, value, limit))
+    if baseline["meta"]["python"] != current["meta"]["python"]:
+        print("=== Warning: baseline was run on", baseline["meta"]["python"], file=sys.stderr)
+    return regressions
+
+def parse_sizes(text):
+    sizes = [int(size) for size in text.split(",")]
+    for size in sizes:
+        if not 0 <= size <= MAX_RESULTS:
+            raise argparse.ArgumentTypeError("sizes must be between 0 and {}".format(MAX_RESULTS))
+    return sizes
+
+###### MAIN PROGRAM ###############################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark code.py against replayed Google traffic.")
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes(DEFAULT_SIZES),
+                        help="comma-separated calendar sizes, 0-2500 (default: %s)" % DEFAULT_SIZES)
+    parser.add_argument("--repeats", type=int, default=5, help="timed cycles per size")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every request")
+    parser.add_argument("--bandwidth-kbps", type=float, default=0.0, help="0 means unthrottled")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance each request fails")
+    parser.add_argument("--error-kind", choices=ERROR_KINDS, default="drop",
+                        help="drop the connection (code.py retries) or answer 500 (code.py raises)")
+    parser.add_argument("--seed", type=int, default=0, help="seeds error injection")
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--baseline", help="results JSON from an earlier run to gate against")
+    parser.add_argument("--thresholds", default=THRESHOLDS_PATH)
+    args = parser.parse_args()
+    if args.repeats < 1:
+        parser.error("--repeats must be at least 1")
+    if not 0 <= args.error_rate < 1:
+        parser.error("--error-rate must be at least 0 and below 1")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+        baseline_config = baseline["meta"]["config"]
+        mismatched = [key for key in SHAPING_OPTIONS if baseline_config.get(key) != getattr(args, key)]
+        if mismatched:
+            parser.error("--baseline was run with different traffic settings, so it can't be compared: "
+                         + ", ".join("{} {} vs {}".format(key, baseline_config.get(key), getattr(args, key))
+                                     for key in mismatched))
+
+    report = benchmark(args)
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if args.baseline:
+        regressions = check_regressions(baseline, report, thresholds)
+        for regression in regressions:
+            print("=== Regression", regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("=== No regressions against", args.baseline, file=sys.stderr)
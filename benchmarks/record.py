@@ -0,0 +1,139 @@
+# Records the real OAuth token refresh and Calendar events exchanges that code.py makes,
+# strips out secrets, and saves them as fixtures for replay_server.py and bench.py.
+# Runs on a desktop Python 3 install, not on the PyPortal. Needs a filled-in secrets.py.
+#
+#   python benchmarks/record.py
+
+import json
+import os
+import sys
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta, timezone
+
+from replay_server import MAX_RESULTS
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+try:
+    from secrets import secrets
+except ImportError:
+    print("WiFi secrets are kept in secrets.py, please add them there!")
+    raise
+
+FIXTURES_DIR = os.path.join(BENCH_DIR, "fixtures")
+TOKEN_URL = "https://oauth2.googleapis.com/token"
+CALENDAR_URL = "https://www.googleapis.com/calendar/v3/calendars/"
+LOOKAHEAD_HOURS = 24 * 30
+RFC3339_UTC = "%Y-%m-%dT%H:%M:%SZ"
+REDACTED = "REDACTED"
+# Keys whose values are removed wherever they appear in a recorded JSON body.
+SECRET_KEYS = ("access_token", "refresh_token", "id_token", "client_secret", "client_id")
+# Keys that hold personal details of the calendar owner or attendees. Their whole value is
+# replaced, however deeply it nests, since meeting links, dial-in numbers and PINs hide inside.
+PRIVATE_KEYS = ("email", "displayName", "htmlLink", "hangoutLink", "description", "location",
+                "conferenceData", "attendees", "attachments", "extendedProperties", "source",
+                "workingLocationProperties")
+# Keys whose text code.py displays. They become placeholders of the same length, so the
+# truncation in display_calendar_events() still sees what it would on the real calendar.
+TITLE_KEYS = ("summary",)
+
+########## Functions ###########################################################################
+
+# Replaces every secret or personal value in a decoded JSON body, recursively.
+def redact(value):
+    if isinstance(value, dict):
+        clean = {}
+        for key, item in value.items():
+            if key in SECRET_KEYS:
+                clean[key] = REDACTED
+            elif key in PRIVATE_KEYS:
+                clean[key] = REDACTED
+            elif key in TITLE_KEYS and isinstance(item, str):
+                clean[key] = ((REDACTED + " ") * len(item))[:len(item)]
+            else:
+                clean[key] = redact(item)
+        return clean
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    if isinstance(value, str):
+        for secret in (secrets["google_email"], secrets["google_client_id"],
+                       secrets["google_client_secret"], secrets["google_refresh_token"]):
+            if secret:
+                value = value.replace(secret, REDACTED)
+    return value
+
+# Performs one HTTP exchange. Returns it as a fixture dict with secrets removed, plus the raw body.
+def exchange(method, url, headers, body=None):
+    request = urllib.request.Request(url, data=body, headers=headers, method=method)
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        response = e
+    with response:
+        status = response.status
+        content_type = response.headers.get("Content-Type", "application/json")
+        payload = json.loads(response.read())
+
+    path = urllib.parse.unquote(urllib.parse.urlsplit(url).path).replace(secrets["google_email"], "CALENDAR_ID")
+    fixture = {
+        "request": {"method": method, "path": path},
+        "response": {"status": status, "content_type": content_type, "body": redact(payload)},
+    }
+    return fixture, payload
+
+# Refreshes the access token the same way adafruit_oauth2.OAuth2.refresh_access_token does.
+def record_token():
+    body = urllib.parse.urlencode({
+        "client_id": secrets["google_client_id"],
+        "client_secret": secrets["google_client_secret"],
+        "grant_type": "refresh_token",
+        "refresh_token": secrets["google_refresh_token"],
+    }).encode()
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    fixture, payload = exchange("POST", TOKEN_URL, headers, body)
+    if fixture["response"]["status"] != 200:
+        raise RuntimeError("Unable to refresh access token - has the token been revoked?", fixture["response"]["body"])
+    return fixture, payload["access_token"]
+
+# Fetches as many events as Google will return in one page, so bench.py has real events to scale from.
+def record_calendar(access_token):
+    now = datetime.now(timezone.utc)
+    url = (
+        CALENDAR_URL + urllib.parse.quote(secrets["google_email"]) + "/events"
+        + "?maxResults=" + str(MAX_RESULTS)
+        + "&timeMin=" + now.strftime(RFC3339_UTC)
+        + "&timeMax=" + (now + timedelta(hours=LOOKAHEAD_HOURS)).strftime(RFC3339_UTC)
+        + "&orderBy=startTime"
+        + "&singleEvents=true"
+    )
+    headers = {"Authorization": "Bearer " + access_token, "Accept": "application/json"}
+    fixture, _ = exchange("GET", url, headers)
+    if fixture["response"]["status"] != 200:
+        raise RuntimeError("Error:", fixture["response"]["body"])
+    # code.py only reads events with a timed start and a summary, so all-day and untitled
+    # or private events are dropped.
+    body = fixture["response"]["body"]
+    body["items"] = [event for event in body.get("items", [])
+                     if "dateTime" in event.get("start", {}) and "summary" in event]
+    body.pop("nextPageToken", None)
+    return fixture
+
+def save(name, fixture):
+    path = os.path.join(FIXTURES_DIR, name)
+    with open(path, "w") as f:
+        json.dump(fixture, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print("=== Saved", path)
+
+###### MAIN PROGRAM ###############################################################################
+
+if __name__ == "__main__":
+    token_fixture, access_token = record_token()
+    calendar_fixture = record_calendar(access_token)
+    print("=== Recorded", len(calendar_fixture["response"]["body"]["items"]), "timed events")
+
+    save("oauth_token.json", token_fixture)
+    save("calendar_events.json", calendar_fixture)
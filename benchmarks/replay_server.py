@@ -0,0 +1,243 @@
+# A local stand-in for the Google OAuth and Calendar endpoints that code.py talks to.
+# Serves the fixtures saved by record.py, scaled up to any calendar size, with configurable
+# latency, bandwidth, and error injection. bench.py runs it in-process; it can also be run
+# on its own to poke at it with curl:
+#
+#   python benchmarks/replay_server.py --events 250 --latency-ms 150 --bandwidth-kbps 64
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+TOKEN_PATH = "/token"
+CALENDAR_PATH_PREFIX = "/calendar/v3/calendars/"
+# Google refuses maxResults above this, so it is also the largest calendar we replay.
+MAX_RESULTS = 2500
+# Roughly one TCP segment, so bandwidth throttling trickles the body out like a slow link would.
+CHUNK_SIZE = 1460
+ERROR_KINDS = ("drop", "http500")
+# Same shape as the body Google sends with a 5xx. code.py raises RuntimeError when it sees "error".
+ERROR_BODY = {"error": {"code": 500, "message": "Backend Error", "errors": [{"reason": "backendError"}]}}
+
+########## Functions ###########################################################################
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as f:
+        return json.load(f)
+
+# Builds `count` events by cycling through the recorded ones, giving each a unique id and a start
+# time spread evenly over the next 24 hours so the list stays ordered by startTime.
+def synthesize_events(template_items, count):
+    if count and not template_items:
+        raise ValueError("Calendar fixture has no timed events to scale from")
+    first_start = template_items[0]["start"]["dateTime"] if template_items else ""
+    base = datetime.fromisoformat(first_start[:19]) if first_start else datetime(2023, 5, 8)
+    utc_offset = first_start[19:]
+    step = timedelta(hours=24) / max(count, 1)
+    events = []
+    for i in range(count):
+        event = json.loads(json.dumps(template_items[i % len(template_items)]))
+        start = base + step * i
+        event["id"] = "{}{:04d}".format(event.get("id", "event"), i)
+        event["start"]["dateTime"] = start.replace(microsecond=0).isoformat() + utc_offset
+        event["end"]["dateTime"] = (start + timedelta(minutes=30)).replace(microsecond=0).isoformat() + utc_offset
+        events.append(event)
+    return events
+
+# Wraps a socket file object and adds every byte that passes through it to the server's counters.
+class _CountingFile:
+    def __init__(self, raw, server, counter):
+        self._raw = raw
+        self._server = server
+        self._counter = counter
+
+    def _count(self, data):
+        with self._server.lock:
+            setattr(self._server, self._counter, getattr(self._server, self._counter) + len(data))
+        return data
+
+    def read(self, *args):
+        return self._count(self._raw.read(*args))
+
+    def readline(self, *args):
+        return self._count(self._raw.readline(*args))
+
+    def write(self, data):
+        self._count(data)
+        return self._raw.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "ReplayServer/1.0"
+
+    # Counters are named from the device's side: what the server reads, the device sent.
+    def setup(self):
+        super().setup()
+        self.rfile = _CountingFile(self.rfile, self.server, "bytes_sent")
+        self.wfile = _CountingFile(self.wfile, self.server, "bytes_received")
+
+    # Pinned so the Server header, and the byte counts, don't change with the Python version.
+    def version_string(self):
+        return self.server_version
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        if urlsplit(self.path).path != TOKEN_PATH:
+            self.send_error(404)
+            return
+        self._replay(self.server.token_fixture["response"], self.server.token_body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if not (url.path.startswith(CALENDAR_PATH_PREFIX) and url.path.endswith("/events")):
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        count = self.server.calendar_size
+        if "maxResults" in query:
+            count = min(count, int(query["maxResults"][0]))
+        self._replay(self.server.calendar_fixture["response"], self.server.calendar_body(count))
+
+    # Sends a recorded response, after applying whatever latency, throttling, or failure is configured.
+    def _replay(self, recorded, body):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.error_rate and server.rng.random() < server.error_rate
+            if fail:
+                server.errors += 1
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        status = recorded["status"]
+        if fail and server.error_kind == "drop":
+            self.close_connection = True
+            return
+        if fail:
+            status = 500
+            body = json.dumps(ERROR_BODY).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", recorded["content_type"])
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start:start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if server.bandwidth:
+                time.sleep(len(chunk) / server.bandwidth)
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # latency is in seconds per request, bandwidth in bytes per second (0 means unthrottled),
+    # error_rate is the chance in [0, 1] that any one request fails in the way error_kind describes.
+    def __init__(self, address=("127.0.0.1", 0), calendar_size=5, latency=0.0, bandwidth=0,
+                 error_rate=0.0, error_kind="drop", seed=0, verbose=False):
+        if error_kind not in ERROR_KINDS:
+            raise ValueError("error_kind must be one of " + ", ".join(ERROR_KINDS))
+        if not 0 <= calendar_size <= MAX_RESULTS:
+            raise ValueError("calendar_size must be between 0 and {}".format(MAX_RESULTS))
+        super().__init__(address, ReplayHandler)
+        self.token_fixture = load_fixture("oauth_token.json")
+        self.calendar_fixture = load_fixture("calendar_events.json")
+        self.token_body = json.dumps(self.token_fixture["response"]["body"]).encode()
+        self.calendar_size = calendar_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_kind = error_kind
+        self.rng = random.Random(seed)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self._calendar_bodies = {}
+        self.reset_counters()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def reset_counters(self):
+        with self.lock:
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.requests = 0
+            self.errors = 0
+
+    def counters(self):
+        with self.lock:
+            return {"bytes_sent": self.bytes_sent, "bytes_received": self.bytes_received,
+                    "requests": self.requests, "errors": self.errors}
+
+    # Encoded once per size, so building the body never counts against the fetch being measured.
+    def calendar_body(self, count):
+        body = self._calendar_bodies.get(count)
+        if body is None:
+            recorded = self.calendar_fixture["response"]["body"]
+            payload = dict(recorded, items=synthesize_events(recorded.get("items", []), count))
+            body = self._calendar_bodies[count] = json.dumps(payload).encode()
+        return body
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+# Runs a ReplayServer until killed, for use as a multiprocessing target. Sends its base_url down `conn`.
+def serve(conn, **options):
+    server = ReplayServer(**options)
+    conn.send(server.base_url)
+    conn.close()
+    server.serve_forever()
+
+###### MAIN PROGRAM ###############################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded Google OAuth and Calendar traffic.")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--events", type=int, default=5, help="calendar size to serve, 0-2500")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--bandwidth-kbps", type=float, default=0.0, help="0 means unthrottled")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-kind", choices=ERROR_KINDS, default="drop")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = ReplayServer(
+        ("127.0.0.1", args.port),
+        calendar_size=args.events,
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_kbps * 1000 / 8,
+        error_rate=args.error_rate,
+        error_kind=args.error_kind,
+        seed=args.seed,
+        verbose=True,
+    )
+    print("=== Replaying fixtures on", server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()